@@ -10,6 +10,14 @@ class Vars:
     ACTIVATION_BYTES = 'ACTIVATION_BYTES'
     INTERVAL = 'INTERVAL'
     VERBOSITY = 'VERBOSITY'
+    LOG_JSON = 'LOG_JSON'
+    CONTROL_SOCKET = 'CONTROL_SOCKET'
+    CONTROL_PORT = 'CONTROL_PORT'
+    PREFETCH = 'PREFETCH'
+    PREFETCH_CACHE = 'PREFETCH_CACHE'
+    PREFETCH_CACHE_SIZE = 'PREFETCH_CACHE_SIZE'
+    MIN_CHAPTER_LENGTH = 'MIN_CHAPTER_LENGTH'
+    MAX_CHAPTER_LENGTH = 'MAX_CHAPTER_LENGTH'
 
 def _cast_bool(name: str, value: Any) -> bool:
     if type(value) == bool:
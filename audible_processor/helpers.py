@@ -1,6 +1,36 @@
+import argparse
+import json
 import logging
 
-def get_logger(name: str, verbosity: int) -> logging.Logger:
+# Structured fields that may be attached to a record with `extra=`
+LOG_FIELDS = ('book', 'chapter', 'stage', 'duration')
+
+class JsonFormatter(logging.Formatter):
+    """Formats each record as a single line JSON object"""
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'process': record.processName,
+            'message': record.getMessage(),
+        }
+        for field in LOG_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+
+        return json.dumps(entry)
+
+def validate_chapter_lengths(parser: argparse.ArgumentParser, options: argparse.Namespace):
+    """Exit with a usage error if the silence detection chapter lengths are invalid"""
+    if options.min_chapter_length <= 0 or options.max_chapter_length <= options.min_chapter_length:
+        parser.error('--max-chapter-length ({}) must be greater than --min-chapter-length ({}), which must be positive'.format(
+            options.max_chapter_length, options.min_chapter_length))
+
+def get_logger(name: str, verbosity: int, json_format: bool = False) -> logging.Logger:
     if verbosity == 0:
         log_level = logging.WARNING
         format = '%(message)s'
@@ -11,6 +41,11 @@ def get_logger(name: str, verbosity: int) -> logging.Logger:
         log_level = logging.DEBUG
         format = '%(asctime)s - %(levelname)s - %(message)s'
 
-    logging.basicConfig(level=log_level, format=format)
+    if json_format:
+        handler = logging.StreamHandler()
+        handler.setFormatter(JsonFormatter())
+        logging.basicConfig(level=log_level, handlers=[handler])
+    else:
+        logging.basicConfig(level=log_level, format=format)
 
     return logging.getLogger(name)
@@ -1,12 +1,14 @@
 import argparse
 import logging
+import multiprocessing as mp
+import os
 import sys
 from array import array
 from glob import glob
 
 from env import Vars, envDefault
-from helpers import get_logger
-from src import AudibleTools, Parser, ParserConfig
+from helpers import get_logger, validate_chapter_lengths
+from src import AudibleTools, JobProfiler, Parser, ParserConfig, StateManager
 
 
 def file_generator(files):
@@ -14,6 +16,21 @@ def file_generator(files):
         for f in glob(path):
             yield f
 
+def retag(parser: Parser, state: StateManager, file: str, source: str = None):
+    source = source or state.get_state(file).get('output_dir')
+    if not source:
+        raise Exception('No existing output recorded for \'{}\'. Use --retag-from.'.format(file))
+
+    # Without a title dir, several books share the folder and we can't tell their chapters apart
+    file = os.path.abspath(file)
+    for other, book in state.get_all_states().items():
+        if other != file and book.get('output_dir') and os.path.abspath(book['output_dir']) == os.path.abspath(source):
+            raise Exception('\'{}\' also holds the output of \'{}\', it can not be retagged'.format(source, other))
+
+    output_dir = parser.retag(source)
+    state.relocate(source, output_dir)
+    state.update_state(file, output_dir=os.path.abspath(output_dir))
+
 def main(prog: str, args: array):
     parser = argparse.ArgumentParser(prog=prog, description='Convert an audiobook into chapterized mp3s')
     parser.add_argument('-o', '--out', default=envDefault(Vars.OUTPUT_DIR, ''),
@@ -30,16 +47,40 @@ def main(prog: str, args: array):
         help='Force the parsing to continue if a recoverable error is encountered')
     parser.add_argument('-b', '--activation-bytes', default=envDefault(Vars.ACTIVATION_BYTES, ''),
         help='The activation bytes used to decrypt audible DRM (automatic probe if not passed)')
+    parser.add_argument('--min-chapter-length', default=envDefault(Vars.MIN_CHAPTER_LENGTH, 300), type=int,
+        help='The minimum length in seconds of a chapter detected from silence (files without chapter markers)')
+    parser.add_argument('--max-chapter-length', default=envDefault(Vars.MAX_CHAPTER_LENGTH, 1800), type=int,
+        help='The maximum length in seconds of a chapter detected from silence (files without chapter markers)')
+    parser.add_argument('--retag', default=False, action='store_true',
+        help='Only rewrite the tags of existing output and move it to the current author/title directory')
+    parser.add_argument('--retag-from',
+        help='The existing output directory to retag, for a single file (defaults to the one recorded in the state file by the last run)')
+    parser.add_argument('--profile', default=False, action='store_true',
+        help='Profile each book and save a .prof file and a summary next to its output')
     parser.add_argument('-v', '--verbose', default=envDefault(Vars.VERBOSITY, 0), action='count')
+    parser.add_argument('--log-json', default=envDefault(Vars.LOG_JSON, False), action=argparse.BooleanOptionalAction,
+        help='Write the logs as one JSON object per line')
     parser.add_argument('file', nargs='+', action='extend',
         help='The file that we are going to convert')
 
     options = parser.parse_args(args)
+    validate_chapter_lengths(parser, options)
 
-    logger = get_logger(__name__, options.verbose)
+    files = list(file_generator(options.file))
+    if options.retag_from and not options.retag:
+        parser.error('--retag-from requires --retag')
+    if options.retag_from and len(files) > 1:
+        parser.error('--retag-from can only be used with a single file')
+    if options.retag and options.profile:
+        parser.error('--profile can not be used with --retag')
+    if options.retag and not options.title_dir:
+        parser.error('--retag requires --title-dir, the chapters of each book must be in their own directory')
+
+    logger = get_logger(__name__, options.verbose, options.log_json)
     audible = AudibleTools(options.out, logger)
+    state = StateManager(options.out, mp.Lock())
 
-    for file in file_generator(options.file):
+    for file in files:
         config = ParserConfig(
             activation_bytes=options.activation_bytes,
             input_file=file,
@@ -49,10 +90,20 @@ def main(prog: str, args: array):
             title_override=options.title,
             create_title_dir=options.title_dir,
             force=options.force,
+            min_chapter_length=options.min_chapter_length,
+            max_chapter_length=options.max_chapter_length,
+            log_json=options.log_json,
         )
 
         try:
-            Parser(config=config, audible=audible, logger=logger).run()
+            profiler = JobProfiler() if options.profile else None
+            book_parser = Parser(config=config, audible=audible, logger=logger, profiler=profiler)
+            if options.retag:
+                retag(book_parser, state, file, options.retag_from)
+            else:
+                output_dir = book_parser.run()
+                # Remember where the output went, so it can be retagged later
+                state.update_state(file, output_dir=os.path.abspath(output_dir))
         except Exception as e:
             if logger.isEnabledFor(logging.DEBUG):
                 logger.exception(e)
@@ -1,4 +1,6 @@
 from .audible_tools.audible_tools import AudibleTools
 from .parser.parser import Parser, ParserConfig
+from .parser.profiler import JobProfiler
 from .monitor.config import DaemonConfig
 from .monitor.daemon import Daemon
+from .monitor.file_processor import StateManager
@@ -23,10 +23,10 @@ class AudibleTools:
         search = pathlib.Path(self.search_dir)
 
         # validate base dir exists and is a directory and is writable
-        self.logger.debug('Checking if \'{}\' exists'.format(search))
+        self.logger.debug('Checking if \'%s\' exists', search)
         if not search.is_dir():
             raise NotADirectoryError('\'{}\' is not a directory'.format(search))
-        self.logger.debug('Checking if \'{}\' is writable'.format(search))
+        self.logger.debug('Checking if \'%s\' is writable', search)
         if not os.access(search, os.W_OK):
             raise PermissionError('\'{}\' is not writable'.format(search))
 
@@ -9,3 +9,12 @@ class DaemonConfig:
     create_title_dir: bool
     interval: int
     threads: int
+    min_chapter_length: int
+    max_chapter_length: int
+    control_socket: str
+    control_port: int
+    profile: bool
+    log_json: bool
+    prefetch: int
+    prefetch_cache: str
+    prefetch_cache_size: int
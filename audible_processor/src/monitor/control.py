@@ -0,0 +1,184 @@
+import json
+import os
+import socketserver
+import threading
+from dataclasses import asdict
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from logging import Logger
+from typing import Any, Dict, List
+from urllib.parse import parse_qs, urlparse
+
+from src.parser.parser import SUPPORTED_INPUT_TYPES
+from .file_processor import StateManager
+from .jobs import JobQueue
+
+
+class ControlError(Exception):
+    """An error to report back to the client"""
+    def __init__(self, status: HTTPStatus, message: str) -> None:
+        self.status = status
+        super().__init__(message)
+
+class _UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+class _ControlHandler(BaseHTTPRequestHandler):
+    """JSON API for the daemon
+
+    GET  /jobs                       list the queued jobs
+    POST /jobs          {path, priority, force, profile}  queue a file (again)
+    POST /jobs/cancel   {path}       remove a queued file
+    POST /jobs/requeue  {path, priority, profile}  process a file again, even if already processed
+    GET  /books[?path=]              state of one or all books
+
+    POST bodies must be sent as application/json, and paths must be in the watched directory.
+    """
+    server: Any
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == '/jobs':
+            self._respond(lambda: [asdict(job) for job in self.server.control.jobs.jobs()])
+        elif url.path == '/books':
+            query = parse_qs(url.query)
+            self._respond(lambda: self.server.control.book_state(query.get('path', [None])[0]))
+        else:
+            self._send(HTTPStatus.NOT_FOUND, {'error': 'Unknown endpoint \'{}\''.format(url.path)})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        control = self.server.control
+        # Browsers can't send application/json cross origin without a CORS preflight, which we never answer
+        content_type = self.headers.get('Content-Type', '').split(';')[0].strip().lower()
+        if content_type != 'application/json':
+            self._send(HTTPStatus.UNSUPPORTED_MEDIA_TYPE, {'error': 'Content-Type must be application/json'})
+        elif url.path == '/jobs':
+            self._respond(lambda: control.enqueue(self._read_body(), force=False), HTTPStatus.ACCEPTED)
+        elif url.path == '/jobs/requeue':
+            self._respond(lambda: control.enqueue(self._read_body(), force=True), HTTPStatus.ACCEPTED)
+        elif url.path == '/jobs/cancel':
+            self._respond(lambda: control.cancel(self._read_body()))
+        else:
+            self._send(HTTPStatus.NOT_FOUND, {'error': 'Unknown endpoint \'{}\''.format(url.path)})
+
+    def _read_body(self) -> Dict[str, Any]:
+        length = int(self.headers.get('Content-Length') or 0)
+        try:
+            body = json.loads(self.rfile.read(length) or b'{}')
+        except ValueError:
+            raise ControlError(HTTPStatus.BAD_REQUEST, 'Body is not valid JSON')
+        if not isinstance(body, dict):
+            raise ControlError(HTTPStatus.BAD_REQUEST, 'Body must be a JSON object')
+        return body
+
+    def _respond(self, action, status: HTTPStatus = HTTPStatus.OK):
+        try:
+            self._send(status, action())
+        except ControlError as e:
+            self._send(e.status, {'error': str(e)})
+        except Exception as e:
+            self.server.control.logger.exception(e)
+            self._send(HTTPStatus.INTERNAL_SERVER_ERROR, {'error': str(e)})
+
+    def _send(self, status: HTTPStatus, body: Any):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format: str, *args):
+        self.server.control.logger.debug('control: ' + format, *args)
+
+    def address_string(self) -> str:
+        # Unix sockets have no client address
+        return self.client_address[0] if self.client_address else 'local'
+
+class ControlServer:
+    """Local API to submit and manage jobs without waiting for the file observer"""
+    jobs: JobQueue
+    state: StateManager
+    input_dir: str
+    logger: Logger
+
+    _servers: List[socketserver.BaseServer]
+
+    def __init__(self, jobs: JobQueue, state: StateManager, input_dir: str, logger: Logger) -> None:
+        self.jobs = jobs
+        self.state = state
+        self.input_dir = os.path.realpath(input_dir)
+        self.logger = logger
+        self._servers = []
+
+    def start(self, socket_path: str = '', port: int = 0):
+        """Serve on the unix socket and/or the localhost port, whichever are set"""
+        if socket_path:
+            if os.path.exists(socket_path):
+                os.unlink(socket_path)
+            self._serve(_UnixHTTPServer(socket_path, _ControlHandler))
+            self.logger.info('Control API listening on \'%s\'', socket_path)
+        if port:
+            self._serve(ThreadingHTTPServer(('127.0.0.1', port), _ControlHandler))
+            self.logger.info('Control API listening on 127.0.0.1:%d', port)
+
+    def stop(self):
+        for server in self._servers:
+            server.shutdown()
+            server.server_close()
+            if isinstance(server, _UnixHTTPServer) and os.path.exists(server.server_address):
+                os.unlink(server.server_address)
+        self._servers = []
+
+    def _serve(self, server: socketserver.BaseServer):
+        server.control = self
+        threading.Thread(target=server.serve_forever, name='control-api', daemon=True).start()
+        self._servers.append(server)
+
+    def enqueue(self, body: Dict[str, Any], force: bool) -> Dict[str, Any]:
+        path = self._get_path(body)
+        if os.path.commonpath([os.path.realpath(path), self.input_dir]) != self.input_dir:
+            raise ControlError(HTTPStatus.FORBIDDEN, '\'{}\' is not in the watched directory'.format(path))
+        if os.path.splitext(path)[1].lower().lstrip('.') not in SUPPORTED_INPUT_TYPES:
+            raise ControlError(HTTPStatus.BAD_REQUEST, '\'{}\' does not have a known type ({})'.format(
+                path, ', '.join(SUPPORTED_INPUT_TYPES)))
+        if not os.path.isfile(path):
+            raise ControlError(HTTPStatus.BAD_REQUEST, '\'{}\' is not a file'.format(path))
+        try:
+            priority = int(body.get('priority', 0))
+        except (TypeError, ValueError):
+            raise ControlError(HTTPStatus.BAD_REQUEST, 'priority must be an integer')
+
+        force = force or bool(body.get('force', False))
+        if not force and self.state.is_done(path):
+            raise ControlError(HTTPStatus.CONFLICT, '\'{}\' was already processed, use /jobs/requeue'.format(path))
+        profile = bool(body.get('profile', False))
+        self.logger.info('Queueing \'%s\' with priority %d from control API', path, priority)
+        if not self.jobs.put(path, priority=priority, force=force, profile=profile):
+            raise ControlError(HTTPStatus.CONFLICT, '\'{}\' is being processed right now'.format(path))
+        return {'path': path, 'priority': priority, 'force': force, 'profile': profile}
+
+    def cancel(self, body: Dict[str, Any]) -> Dict[str, Any]:
+        path = self._get_path(body)
+        if not self.jobs.cancel(path):
+            raise ControlError(HTTPStatus.CONFLICT, '\'{}\' is not queued (already started or unknown)'.format(path))
+        self.logger.info('Cancelled \'%s\' from control API', path)
+        return {'path': path, 'cancelled': True}
+
+    def book_state(self, path: str = None) -> Dict[str, Any]:
+        if path is None:
+            return self.state.get_all_states()
+
+        path = os.path.abspath(path)
+        state = dict(self.state.get_state(path))
+        queued = any(job.path == path for job in self.jobs.jobs())
+        if not state and not queued:
+            raise ControlError(HTTPStatus.NOT_FOUND, 'No state for \'{}\''.format(path))
+        return {'path': path, 'queued': queued, **state}
+
+    def _get_path(self, body: Dict[str, Any]) -> str:
+        path = body.get('path')
+        if not isinstance(path, str) or not path.strip():
+            raise ControlError(HTTPStatus.BAD_REQUEST, 'path is required')
+        return os.path.abspath(path)
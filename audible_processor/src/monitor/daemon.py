@@ -1,7 +1,10 @@
+import logging
 import multiprocessing as mp
 import os.path
+import threading
 import time
 from logging import Logger
+from logging.handlers import QueueListener
 from os import walk
 from typing import List
 
@@ -11,7 +14,10 @@ from watchdog.observers.polling import PollingObserver
 
 from src import AudibleTools
 from .config import DaemonConfig
-from .file_processor import file_processor
+from .control import ControlServer
+from .file_processor import StateManager, file_processor
+from .jobs import JobQueue
+from .prefetch import Prefetcher
 
 
 class ProcessPool:
@@ -42,17 +48,32 @@ class Daemon:
     audible: AudibleTools
     logger: Logger
 
+    _jobs: JobQueue
     _queue: mp.Queue
+    _log_queue: mp.Queue
+    _lock: mp.Lock
+    _state: StateManager
+    _idle: mp.Semaphore
+    _done: mp.Queue
 
     def __init__(self, config: DaemonConfig, audible: AudibleTools, logger: Logger) -> None:
         self.config = config
         self.audible = audible
         self.logger = logger
 
+        self._jobs = JobQueue()
         self._queue = mp.Queue()
+        self._log_queue = mp.Queue()
+        self._lock = mp.Lock()
+        self._state = StateManager(config.output_dir, self._lock)
+        # Released by a worker each time it is ready for another job
+        self._idle = mp.Semaphore(0)
+        # Paths the workers have finished with
+        self._done = mp.Queue()
 
     def run(self, path: str):
-        observer = processor = None
+        observer = processor = control = None
+        listener = self._start_log_listener()
 
         # Wait until an auth file exists before attempt to start
         self._wait_for_auth()
@@ -60,6 +81,9 @@ class Daemon:
         try:
             observer = self._start_file_observer(path)
             processor = self._start_file_processor()
+            prefetcher = self._start_prefetcher()
+            self._start_dispatcher(prefetcher)
+            control = self._start_control_server(path)
 
             # Loop through existing files in the path and add them to the queue
             self._queue_existing_files(path)
@@ -75,6 +99,9 @@ class Daemon:
             self.logger.info('stopping')
         finally:
             self.logger.info('shutting down')
+            if control:
+                control.stop()
+
             # Kill sub processes and wait until they stop
             if observer and observer.is_alive():
                 observer.stop()
@@ -85,9 +112,12 @@ class Daemon:
                 processor.join()
                 processor.close()
 
+            # Flush anything the workers logged before they stopped
+            listener.stop()
+
     def _get_on_create_handler(self):
         def on_create(event):
-            self.logger.info('monitoring \'{}\' for steady state'.format(event.src_path))
+            self.logger.info('monitoring \'%s\' for steady state', event.src_path)
 
             new_size = os.path.getsize(event.src_path)
             while True:
@@ -96,10 +126,13 @@ class Daemon:
                 new_size = os.path.getsize(event.src_path)
 
                 if old_size == new_size:
-                    self.logger.info('monitoring \'{}\' finished'.format(event.src_path))
+                    self.logger.info('monitoring \'%s\' finished', event.src_path)
                     break
 
-            self._queue.put(event.src_path)
+            if self._state.is_done(event.src_path):
+                self.logger.debug('Skipping \'%s\'. Already processed.', event.src_path)
+            else:
+                self._jobs.put(event.src_path)
 
         return on_create
 
@@ -130,25 +163,76 @@ class Daemon:
         observer = PollingObserver(timeout=self.config.interval)
         observer.schedule(event_handler, path, recursive=True)
 
-        self.logger.info('watching \'{}\''.format(path))
+        self.logger.info('watching \'%s\'', path)
         observer.start()
 
         return observer
 
+    def _start_log_listener(self) -> QueueListener:
+        """Write the records sent by the worker processes through our own handlers"""
+        listener = QueueListener(self._log_queue, *logging.getLogger().handlers, respect_handler_level=True)
+        listener.start()
+        return listener
+
     def _start_file_processor(self) -> ProcessPool:
         self.logger.info('Starting file processor')
 
-        lock = mp.Lock()
         pool = ProcessPool(
             self.config.threads,
             target=file_processor,
-            args=(self.config, self._queue, lock, self.logger.level))
+            args=(self.config, self._queue, self._idle, self._done, self._log_queue, self._lock, self.logger.getEffectiveLevel()))
 
         pool.start()
         return pool
 
+    def _start_prefetcher(self) -> Prefetcher:
+        if self.config.prefetch <= 0:
+            return None
+
+        prefetcher = Prefetcher(
+            self._jobs,
+            depth=self.config.prefetch,
+            cache_dir=self.config.prefetch_cache,
+            cache_size=self.config.prefetch_cache_size * 1024 * 1024,
+            logger=self.logger)
+        prefetcher.start()
+        return prefetcher
+
+    def _start_dispatcher(self, prefetcher: Prefetcher = None):
+        """Move jobs from the priority queue to the workers as they become free
+
+        Jobs stay in the priority queue, where they can be reordered and cancelled,
+        until a worker says it is idle.
+        """
+        def dispatch():
+            while True:
+                self._idle.acquire()
+                job = self._jobs.get()
+                if prefetcher:
+                    job.local_path = prefetcher.claim(job.path)
+                self.logger.debug('Dispatching \'%s\'', job.path)
+                self._queue.put(job)
+
+        def finish():
+            while True:
+                self._jobs.finish(self._done.get())
+
+        threading.Thread(target=dispatch, name='dispatcher', daemon=True).start()
+        threading.Thread(target=finish, name='finisher', daemon=True).start()
+
+    def _start_control_server(self, path: str) -> ControlServer:
+        if not self.config.control_socket and not self.config.control_port:
+            return None
+
+        control = ControlServer(self._jobs, self._state, path, self.logger)
+        control.start(self.config.control_socket, self.config.control_port)
+        return control
+
     def _queue_existing_files(self, path: str):
+        # Only queue what still needs work, so the prefetcher never reads finished books
+        done = self._state.done_paths()
         for (dirpath, _, filenames) in walk(path):
             for file in filenames:
-                if len(file) > 4 and file[-4:].lower() == '.aax':
-                    self._queue.put(os.path.join(dirpath, file))
+                file_path = os.path.abspath(os.path.join(dirpath, file))
+                if len(file) > 4 and file[-4:].lower() == '.aax' and file_path not in done:
+                    self._jobs.put(file_path)
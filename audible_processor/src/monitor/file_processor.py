@@ -1,29 +1,43 @@
 import configparser
+import hashlib
 import logging
 import multiprocessing as mp
 import os.path
+import time
 from contextlib import contextmanager
 from datetime import datetime
 from enum import Enum
+from logging.handlers import QueueHandler
 from queue import Empty
-from typing import Any, Dict
+from typing import Any, Dict, Optional, Set, Tuple
 
-from src import AudibleTools, Parser, ParserConfig
+from src import AudibleTools, JobProfiler, Parser, ParserConfig
 from .config import DaemonConfig
+from .jobs import Job
+from .prefetch import release_cached
 
 STATE_FILE = '.books.ini'
 
+# Bytes hashed from each end of a file for its fingerprint
+FINGERPRINT_BLOCK = 1024 * 1024
+
 class FileStatus(Enum):
     DISCOVERED = 1
     ERROR = 2
+    DUPLICATE = 3
     PROCESSED = 5
 
+# Files that never need to be looked at again, unless forced
+DONE_STATUSES = (str(FileStatus.PROCESSED), str(FileStatus.DUPLICATE))
+
 class LogPrefixAdapter(logging.LoggerAdapter):
     def __init__(self, prefix: str, logger: logging.Logger, extra=None):
         self._prefix = prefix
         super().__init__(logger, extra)
 
     def process(self, msg, kwargs):
+        # Keep the adapter's extra fields while still allowing per-call ones
+        kwargs['extra'] = { **(self.extra or {}), **kwargs.get('extra', {}) }
         return '{}{}'.format(self._prefix, msg), kwargs
 
 @contextmanager
@@ -37,6 +51,38 @@ def atomic_lock(lock: mp.Lock):
 def str_truncate(s: str, to_len: int, suffix: str = '...'):
     return s if len(s) <= to_len + len(suffix) else '{}{}'.format(s[:to_len], suffix)
 
+def file_fingerprint(path: str, block: int = FINGERPRINT_BLOCK) -> str:
+    """Identify a file by its content without reading all of it: the size plus a hash of the head and tail"""
+    size = os.path.getsize(path)
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        digest.update(f.read(block))
+        if size > block:
+            f.seek(max(block, size - block))
+            digest.update(f.read(block))
+    return '{}-{}'.format(size, digest.hexdigest())
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass # exists, owned by someone else
+    return True
+
+def _in_progress(book) -> bool:
+    """Whether a worker that is still running has claimed this book
+
+    A DISCOVERED book whose worker is gone was interrupted, e.g. by a restart.
+    """
+    if book.get('status') != str(FileStatus.DISCOVERED):
+        return False
+    try:
+        return _pid_alive(int(book.get('worker', '')))
+    except ValueError:
+        return False
+
 class StateManager:
     lock: mp.Lock
     _path: str
@@ -46,19 +92,94 @@ class StateManager:
         self._path = os.path.join(output_dir, STATE_FILE)
 
     def _load_state(self):
-        config = configparser.ConfigParser()
+        # No interpolation, paths and error messages may contain '%'
+        config = configparser.ConfigParser(interpolation=None)
         config.read(self._path)
         return config
 
     def _save_state(self, state: configparser.ConfigParser):
-        with open(self._path, 'w') as file:
+        # Replace the file in one step so unlocked readers never see it half written
+        tmp_path = '{}.{}.tmp'.format(self._path, os.getpid())
+        with open(tmp_path, 'w') as file:
             state.write(file)
+        os.replace(tmp_path, self._path)
 
     def get_state(self, path: str) -> Dict[str, Any]:
         state = self._load_state()
         abs_path = os.path.abspath(path)
         return state[abs_path] if state.has_section(abs_path) else {}
 
+    def is_done(self, path: str) -> bool:
+        """Whether the file was already processed, or skipped as a duplicate"""
+        return self.get_state(path).get('status', None) in DONE_STATUSES
+
+    def done_paths(self) -> Set[str]:
+        """All the files that were already processed, or skipped as duplicates"""
+        state = self._load_state()
+        return { section for section in state.sections() if state[section].get('status') in DONE_STATUSES }
+
+    def get_all_states(self) -> Dict[str, Dict[str, Any]]:
+        state = self._load_state()
+        return { section: dict(state[section]) for section in state.sections() }
+
+    def claim(self, path: str, fingerprint: str, check_duplicates: bool = True) -> Optional[Tuple[str, Dict[str, Any]]]:
+        """Mark the file as discovered, unless another path with the same fingerprint is processed or in progress
+
+        Both happen under the lock, so two workers can never claim the same content.
+        Returns the path that already has it and its state, which is this path itself
+        when another worker is processing it right now. Only a match that was processed
+        marks this file as a duplicate. While the match is in progress nothing is recorded,
+        so the file is picked up again if that one fails.
+        """
+        abs_path = os.path.abspath(path)
+        with atomic_lock(self.lock):
+            state = self._load_state()
+
+            if check_duplicates and state.has_section(abs_path) and _in_progress(state[abs_path]):
+                return abs_path, dict(state[abs_path])
+
+            for section in state.sections() if check_duplicates else []:
+                book = state[section]
+                if section == abs_path or book.get('fingerprint') != fingerprint:
+                    continue
+
+                if book.get('status') == str(FileStatus.PROCESSED):
+                    state[abs_path] = {
+                        **(state[abs_path] if state.has_section(abs_path) else {}),
+                        'status': FileStatus.DUPLICATE,
+                        'fingerprint': fingerprint,
+                        'duplicate_of': section,
+                        'output_dir': book.get('output_dir', ''),
+                        'end_date': datetime.now(),
+                    }
+                    self._save_state(state)
+                    return section, dict(book)
+                # An interrupted or moved book will never produce an output, don't wait for it
+                if _in_progress(book) and os.path.exists(section):
+                    return section, dict(book)
+
+            state[abs_path] = {
+                **(state[abs_path] if state.has_section(abs_path) else {}),
+                'status': FileStatus.DISCOVERED,
+                'fingerprint': fingerprint,
+                'worker': os.getpid(),
+                'start_date': datetime.now(),
+            }
+            self._save_state(state)
+            return None
+
+    def relocate(self, old_dir: str, new_dir: str):
+        """Point every book whose output was in old_dir at new_dir"""
+        old_dir = os.path.abspath(old_dir)
+        new_dir = os.path.abspath(new_dir)
+        with atomic_lock(self.lock):
+            state = self._load_state()
+            for section in state.sections():
+                output_dir = state[section].get('output_dir')
+                if output_dir and os.path.abspath(output_dir) == old_dir:
+                    state[section]['output_dir'] = new_dir
+            self._save_state(state)
+
     def update_state(self, path: str, **kwargs):
         abs_path = os.path.abspath(path)
         with atomic_lock(self.lock):
@@ -69,7 +190,16 @@ class StateManager:
                 state[abs_path] = kwargs
             self._save_state(state)
 
-def file_processor(config: DaemonConfig, queue: mp.Queue, lock: mp.Lock, log_level: int = logging.DEBUG):
+def _setup_worker_logging(log_queue: mp.Queue, log_level: int):
+    """Send every record from this process to the daemon's listener instead of writing it ourselves"""
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(QueueHandler(log_queue))
+    root.setLevel(log_level)
+
+def file_processor(config: DaemonConfig, queue: mp.Queue, idle: mp.Semaphore, done: mp.Queue, log_queue: mp.Queue, lock: mp.Lock, log_level: int = logging.DEBUG):
+    _setup_worker_logging(log_queue, log_level)
     logger = logging.getLogger('monitor:file_processor')
     logger.setLevel(log_level)
 
@@ -77,22 +207,34 @@ def file_processor(config: DaemonConfig, queue: mp.Queue, lock: mp.Lock, log_lev
 
     def should_process_file(file: str) -> bool:
         """Determine if we should process the given file"""
-        state = manager.get_state(file)
-        return False if state.get('status', None) == str(FileStatus.PROCESSED) else True
+        return not manager.is_done(file)
 
-    def process_file(file: str):
-        """Do the work to initialize and run the Processor"""
-        logger.debug('Updating state to discovered for \'{}\''.format(file))
-        manager.update_state(file, status=FileStatus.DISCOVERED, start_date=datetime.now())
+    def claim_file(file: str, fingerprint: str, force: bool) -> bool:
+        """Mark the file as discovered. Returns False if the same content was already processed or is in progress."""
+        logger.debug('Updating state to discovered for \'%s\'', file)
+        found = manager.claim(file, fingerprint, check_duplicates=not force)
+        if found is None:
+            return True
+
+        original, book = found
+        if original == os.path.abspath(file):
+            logger.warning('Skipping \'%s\'. Already being processed.', file)
+        elif book.get('status') == str(FileStatus.PROCESSED):
+            logger.warning('Skipping \'%s\'. Same content as \'%s\'.', file, original)
+        else:
+            logger.warning('Skipping \'%s\' for now. Same content as \'%s\', which is being processed.', file, original)
+        return False
 
+    def process_file(file: str, profile: bool = False, input_file: str = None):
+        """Do the work to initialize and run the Processor"""
         # Make a new logger to use for this processor
         basename = os.path.basename(file)
         prefix = str_truncate(basename, 10)
-        sub_logger = LogPrefixAdapter('{}-'.format(prefix), logger)
+        sub_logger = LogPrefixAdapter('{}-'.format(prefix), logger, extra={'book': basename})
         audible = AudibleTools(config.output_dir, sub_logger)
 
         parser_config = ParserConfig(
-            input_file=file,
+            input_file=input_file or file,
             output_dir=config.output_dir,
             activation_bytes=config.activation_bytes,
             create_author_dir=config.create_author_dir,
@@ -100,29 +242,64 @@ def file_processor(config: DaemonConfig, queue: mp.Queue, lock: mp.Lock, log_lev
             create_title_dir=config.create_title_dir,
             title_override='',
             force=True,
+            min_chapter_length=config.min_chapter_length,
+            max_chapter_length=config.max_chapter_length,
+            log_json=config.log_json,
         )
 
+        start = time.monotonic()
         try:
-            Parser(config=parser_config, audible=audible, logger=sub_logger).run()
-            manager.update_state(file, status=FileStatus.PROCESSED, end_date=datetime.now())
+            profiler = JobProfiler() if profile else None
+            output_dir = Parser(config=parser_config, audible=audible, logger=sub_logger, profiler=profiler).run()
+            elapsed = time.monotonic() - start
+            sub_logger.info('Processed in %.1fs', elapsed, extra={'stage': 'book', 'duration': round(elapsed, 3)})
+            manager.update_state(file, status=FileStatus.PROCESSED, output_dir=output_dir, end_date=datetime.now())
         except Exception as e:
-            logger.error(e)
+            sub_logger.error(e, extra={'stage': 'book', 'duration': round(time.monotonic() - start, 3)})
             manager.update_state(file, status=FileStatus.ERROR, error=str(e), end_date=datetime.now())
 
     """Worker function to process a file"""
     try:
         while True:
+            # Ask the dispatcher for the next job
+            idle.release()
+            job: Job = None
+            while job is None:
+                try:
+                    job = queue.get(timeout=0.25)
+                except Empty:
+                    continue # short polls
+            logger.debug('Received file \'%s\'', job.path)
+
             try:
-                to_process = queue.get(timeout=0.25)
-                logger.debug('Received file \'{}\''.format(to_process))
-            except Empty:
-                continue # short polls
-
-            if should_process_file(to_process):
-                logger.debug('Sending \'{}\' for processing'.format(to_process))
-                process_file(to_process)
-            else:
-                logger.debug('Skipping \'{}\'. Already processed.'.format(to_process))
+                if not job.force and not should_process_file(job.path):
+                    logger.debug('Skipping \'%s\'. Already processed.', job.path)
+                    continue
+
+                # Recognize renamed, moved or re-downloaded books before any ffmpeg work
+                try:
+                    fingerprint = file_fingerprint(job.local_path or job.path)
+                except OSError as e:
+                    logger.error(e)
+                    manager.update_state(job.path, status=FileStatus.ERROR, error=str(e), end_date=datetime.now())
+                    continue
+
+                if not claim_file(job.path, fingerprint, job.force):
+                    continue
+
+                logger.debug('Sending \'%s\' for processing', job.path)
+                process_file(job.path, profile=config.profile or job.profile, input_file=job.local_path)
+            except Exception as e:
+                # One bad job must not take the worker, and with it the daemon, down
+                logger.exception(e)
+                try:
+                    manager.update_state(job.path, status=FileStatus.ERROR, error=str(e), end_date=datetime.now())
+                except Exception as state_error:
+                    logger.error('Unable to record the error for \'%s\': %s', job.path, state_error)
+            finally:
+                if job.local_path:
+                    release_cached(job.local_path)
+                done.put(job.path)
     except KeyboardInterrupt:
         logger.debug('Stopping file processor')
 
@@ -0,0 +1,101 @@
+import heapq
+import itertools
+import os.path
+import threading
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Set
+
+
+@dataclass
+class Job:
+    """A file waiting to be processed"""
+    path: str
+    priority: int = 0
+    force: bool = False
+    profile: bool = False
+    # Prefetched local copy of path to read from instead, if any
+    local_path: Optional[str] = None
+
+class JobQueue:
+    """Thread safe priority queue of jobs. Higher priorities are processed first, then oldest first.
+
+    A path is only ever queued once. Queuing it again keeps the higher priority and
+    any force/profile flag. Paths handed out by get() are active until finish(),
+    and queuing them meanwhile is ignored so a book is never processed twice at once.
+    """
+    _heap: List[list]
+    _entries: Dict[str, list]
+    _active: Set[str]
+
+    def __init__(self) -> None:
+        self._heap = []
+        self._entries = {}
+        self._active = set()
+        self._counter = itertools.count()
+        self._cond = threading.Condition()
+
+    def put(self, path: str, priority: int = 0, force: bool = False, profile: bool = False) -> bool:
+        """Queue a path. Returns False if it is being processed right now."""
+        path = os.path.abspath(path)
+        with self._cond:
+            if path in self._active:
+                return False
+
+            old = self._entries.get(path)
+            if old is not None:
+                job = old[-1]
+                job.force = job.force or force
+                job.profile = job.profile or profile
+                if priority <= job.priority:
+                    return True
+                # Move it up, it keeps its flags
+                self._remove(path)
+                job.priority = priority
+            else:
+                job = Job(path=path, priority=priority, force=force, profile=profile)
+
+            entry = [-priority, next(self._counter), job]
+            self._entries[job.path] = entry
+            heapq.heappush(self._heap, entry)
+            self._cond.notify()
+            return True
+
+    def finish(self, path: str):
+        """Mark a path returned by get() as no longer being processed"""
+        with self._cond:
+            self._active.discard(path)
+
+    def is_active(self, path: str) -> bool:
+        with self._cond:
+            return os.path.abspath(path) in self._active
+
+    def cancel(self, path: str) -> bool:
+        """Remove a queued job. Returns False if it was not queued."""
+        with self._cond:
+            return self._remove(os.path.abspath(path))
+
+    def get(self, timeout: Optional[float] = None) -> Optional[Job]:
+        """Pop the next job, waiting up to timeout seconds for one. Returns None on timeout."""
+        with self._cond:
+            while True:
+                while self._heap:
+                    *_, job = heapq.heappop(self._heap)
+                    if job is not None:
+                        del self._entries[job.path]
+                        self._active.add(job.path)
+                        return job
+                if not self._cond.wait(timeout):
+                    return None
+
+    def jobs(self) -> List[Job]:
+        """The queued jobs in the order they will be processed"""
+        with self._cond:
+            return [entry[-1] for entry in sorted(self._entries.values())]
+
+    def _remove(self, path: str) -> bool:
+        entry = self._entries.pop(path, None)
+        if entry is None:
+            return False
+        # Lazy delete, skipped when it reaches the top of the heap
+        entry[-1] = None
+        return True
@@ -0,0 +1,177 @@
+import hashlib
+import os
+import shutil
+import threading
+from collections import OrderedDict
+from logging import Logger
+from typing import List, Optional
+
+from .jobs import JobQueue
+
+# Seconds between checks of the queue
+PREFETCH_INTERVAL = 1
+# We only ever touch this directory inside the configured cache dir
+CACHE_SUBDIR = 'audible-prefetch'
+READ_SIZE = 1024 * 1024
+
+
+def cache_dir_size(path: str) -> int:
+    """Total bytes of the files in the cache, including the ones handed to workers"""
+    total = 0
+    for entry in os.scandir(path):
+        if entry.is_dir(follow_symlinks=False):
+            total += cache_dir_size(entry.path)
+        elif entry.is_file(follow_symlinks=False):
+            try:
+                total += entry.stat(follow_symlinks=False).st_size
+            except FileNotFoundError:
+                pass # released by a worker while we were looking
+    return total
+
+def release_cached(local_path: str):
+    """Delete a cached copy once a worker is done with it"""
+    try:
+        os.remove(local_path)
+    except FileNotFoundError:
+        pass
+    try:
+        os.rmdir(os.path.dirname(local_path))
+    except OSError:
+        pass
+
+def _warm_page_cache(path: str):
+    """Ask the kernel to start reading the whole file into the page cache"""
+    with open(path, 'rb') as f:
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+        else:
+            while f.read(READ_SIZE):
+                pass
+
+class Prefetcher:
+    """Reads the next queued books ahead of the workers
+
+    Without a cache dir, the books are only pulled into the page cache. With one,
+    they are copied into a subdirectory of it, up to cache_size bytes. Copies are handed to the
+    worker with the job, which deletes them when finished. Copies that are no
+    longer near the front of the queue are evicted least recently used first.
+    """
+    jobs: JobQueue
+    depth: int
+    cache_dir: str
+    cache_size: int
+    logger: Logger
+
+    _cached: 'OrderedDict[str, str]'
+
+    def __init__(self, jobs: JobQueue, depth: int, cache_dir: str, cache_size: int, logger: Logger) -> None:
+        self.jobs = jobs
+        self.depth = depth
+        self.cache_dir = os.path.join(cache_dir, CACHE_SUBDIR) if cache_dir else ''
+        self.cache_size = cache_size
+        self.logger = logger
+
+        self._cached = OrderedDict()
+        self._warmed = set()
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+
+    def start(self):
+        if self.cache_dir:
+            # Anything left over is from a previous run
+            shutil.rmtree(self.cache_dir, ignore_errors=True)
+            os.makedirs(self.cache_dir)
+
+        threading.Thread(target=self._run, name='prefetch', daemon=True).start()
+
+    def claim(self, path: str) -> Optional[str]:
+        """Take the cached copy of path, if there is one. The caller is responsible for releasing it."""
+        with self._lock:
+            self._warmed.discard(path)
+            local_path = self._cached.pop(path, None)
+        self._wake.set()
+        return local_path
+
+    def _run(self):
+        while True:
+            self._wake.wait(PREFETCH_INTERVAL)
+            self._wake.clear()
+            try:
+                self._prefetch([job.path for job in self.jobs.jobs()[:self.depth]])
+            except Exception as e:
+                self.logger.error('Prefetch failed: %s', e)
+
+    def _prefetch(self, wanted: List[str]):
+        if not self.cache_dir:
+            self._warmed &= set(wanted)
+            for path in wanted:
+                if path not in self._warmed:
+                    self.logger.debug('Prefetching \'%s\' into the page cache', path)
+                    try:
+                        _warm_page_cache(path)
+                    except OSError as e:
+                        self.logger.debug('Unable to prefetch \'%s\': %s', path, e)
+                    self._warmed.add(path)
+            return
+
+        for path in wanted:
+            with self._lock:
+                if path in self._cached:
+                    self._cached.move_to_end(path)
+                    continue
+
+            try:
+                size = os.path.getsize(path)
+            except OSError as e:
+                # Gone since it was queued, the worker will report it
+                self.logger.debug('Unable to prefetch \'%s\': %s', path, e)
+                continue
+
+            if size > self.cache_size:
+                self.logger.debug('\'%s\' is larger than the prefetch cache', path)
+                continue
+            if not self._make_room(size, wanted):
+                # Keep the queue order, wait for the workers to release space
+                self.logger.debug('No room in the prefetch cache for \'%s\'', path)
+                return
+
+            try:
+                self._copy(path)
+            except OSError as e:
+                self.logger.error('Unable to prefetch \'%s\': %s', path, e)
+
+    def _make_room(self, size: int, wanted: List[str]) -> bool:
+        """Evict unwanted copies, oldest first, until size bytes fit. Returns False if they never will."""
+        used = cache_dir_size(self.cache_dir)
+        with self._lock:
+            for path in list(self._cached):
+                if used + size <= self.cache_size:
+                    break
+                if path in wanted:
+                    continue
+                local_path = self._cached.pop(path)
+                used -= os.path.getsize(local_path)
+                self.logger.debug('Evicting \'%s\' from the prefetch cache', path)
+                release_cached(local_path)
+
+        return used + size <= self.cache_size
+
+    def _copy(self, path: str):
+        entry_dir = os.path.join(self.cache_dir, hashlib.sha1(path.encode('utf-8')).hexdigest()[:16])
+        local_path = os.path.join(entry_dir, os.path.basename(path))
+        os.makedirs(entry_dir, exist_ok=True)
+
+        self.logger.debug('Prefetching \'%s\' into \'%s\'', path, local_path)
+        try:
+            shutil.copyfile(path, local_path + '.part')
+            os.replace(local_path + '.part', local_path)
+        except Exception:
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            raise
+
+        with self._lock:
+            # Dispatched or cancelled while we were copying
+            if not any(job.path == path for job in self.jobs.jobs()):
+                release_cached(local_path)
+                return
+            self._cached[path] = local_path
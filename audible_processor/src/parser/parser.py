@@ -2,12 +2,17 @@ import ffmpeg
 import logging
 import os
 import pathlib
+import time
 from pathvalidate import sanitize_filepath
+from contextlib import contextmanager
 from dataclasses import dataclass
 from logging import Logger
-from typing import List
+from typing import List, Optional
 
 from src import AudibleTools
+from .profiler import JobProfiler
+from .retag import chapter_files, retag_chapters
+from .silence import detect_splits, fixed_splits
 
 
 SUPPORTED_INPUT_TYPES = ['aax', 'aac', 'm4b']
@@ -28,6 +33,9 @@ class ParserConfig:
     create_title_dir: bool
     title_override: str
     force: bool
+    min_chapter_length: int
+    max_chapter_length: int
+    log_json: bool
 
 @dataclass
 class Chapter:
@@ -44,6 +52,7 @@ class MetaData:
     author: str
     title: str
     activation_bytes: str
+    duration: float
     chapters: list[Chapter]
 
 def _get_file_ext(path):
@@ -58,17 +67,105 @@ class Parser:
     config: ParserConfig
     logger: Logger
     audible: AudibleTools
+    profiler: Optional[JobProfiler] = None
 
     def run(self):
+        if self.profiler is None:
+            return self._run()
+
+        try:
+            return self.profiler.runcall(self._run)
+        finally:
+            self._write_profile()
+
+    def _run(self):
         self.logger.warning('Processing %s...', self.config.input_file)
 
         self._validate_activation_bytes()
         self._validate_input_file()
-        meta = self._probe_meta()
+        with self._log_stage('probe'):
+            meta = self._probe_meta()
+        if not meta.chapters:
+            with self._log_stage('silence'):
+                meta.chapters = self._detect_chapters(meta)
 
         output_dir = self._validate_output_dir(meta)
+        if self.profiler:
+            self.profiler.output_dir = output_dir
 
         self._format_audio(meta, output_dir)
+        return output_dir
+
+    def retag(self, source_dir: str) -> str:
+        """Retag the chapters already in source_dir and move them to the output dir for the current config.
+
+        Only the ID3 frames are rewritten, nothing is re-encoded. Returns the new output dir.
+        Every chapter in source_dir is moved and retagged, so it must only hold this book.
+        """
+        if not self.config.create_title_dir:
+            raise Exception('Retagging needs a title directory per book, chapters in a shared folder can not be told apart')
+
+        self.logger.warning('Retagging %s...', self.config.input_file)
+
+        self._validate_activation_bytes()
+        self._validate_input_file()
+        meta = self._probe_meta()
+
+        source = pathlib.Path(source_dir)
+        if not source.is_dir():
+            raise NotADirectoryError('\'{}\' is not a directory'.format(source))
+        if source.resolve() == pathlib.Path(self.config.output_dir).resolve():
+            raise Exception('\'{}\' is the base output directory, not a book directory'.format(source))
+        if not chapter_files(str(source)):
+            raise FileNotFoundError('No chapters found in \'{}\''.format(source))
+
+        output_dir = self._validate_output_dir(meta)
+        if pathlib.Path(output_dir).resolve() != source.resolve():
+            self._move_output(source, pathlib.Path(output_dir))
+
+        count = retag_chapters(output_dir, meta.title, meta.author, self.logger)
+        self.logger.warning('Retagged %d chapters in %s', count, output_dir)
+        return output_dir
+
+    def _move_output(self, source: pathlib.Path, target: pathlib.Path):
+        """Move everything in source to target, then remove source and its parent if they are left empty"""
+        entries = list(source.iterdir())
+        for entry in entries:
+            if target.joinpath(entry.name).exists():
+                raise FileExistsError('\'{}\' already exists'.format(target.joinpath(entry.name)))
+
+        self.logger.info('Moving \'%s\' to \'%s\'', source, target)
+        for entry in entries:
+            os.replace(entry, target.joinpath(entry.name))
+
+        base = pathlib.Path(self.config.output_dir).resolve()
+        for dir in (source, source.parent):
+            if dir.resolve() == base or any(dir.iterdir()):
+                break
+            self.logger.debug('Removing empty folder \'%s\'', dir)
+            os.rmdir(dir)
+
+    @contextmanager
+    def _log_stage(self, stage: str, chapter: int = None):
+        """Log how long the wrapped stage took"""
+        start = time.monotonic()
+        if self.profiler:
+            with self.profiler.measure(stage, chapter):
+                yield
+        else:
+            yield
+        elapsed = time.monotonic() - start
+        self.logger.info('Finished %s in %.1fs', stage, elapsed,
+            extra={'stage': stage, 'chapter': chapter, 'duration': round(elapsed, 3)})
+
+    def _write_profile(self):
+        """Save the profile next to the book's output, or in the base output dir if we never got that far"""
+        output_dir = self.profiler.output_dir or self.config.output_dir
+        try:
+            summary = self.profiler.write(output_dir, _get_file_name(self.config.input_file))
+            self.logger.warning('Profile saved to %s', summary)
+        except Exception as e:
+            self.logger.error('Unable to save profile to \'%s\': %s', output_dir, e)
 
     def _validate_activation_bytes(self):
         activation_bytes = self.config.activation_bytes or self.audible.get_activation_bytes()
@@ -88,13 +185,13 @@ class Parser:
             raise UnknownTypeException(self.config.input_file, SUPPORTED_INPUT_TYPES)
 
         # validate it exists and is a file and is readable
-        self.logger.debug('Checking if \'{}\' exists'.format(input))
+        self.logger.debug('Checking if \'%s\' exists', input)
         if not input.exists():
             raise FileNotFoundError('\'{}\' does not exist'.format(input))
-        self.logger.debug('Checking if \'{}\' is a file'.format(input))
+        self.logger.debug('Checking if \'%s\' is a file', input)
         if not input.is_file():
             raise FileNotFoundError('\'{}\' is not a file'.format(input))
-        self.logger.debug('Checking if \'{}\' is readable'.format(input))
+        self.logger.debug('Checking if \'%s\' is readable', input)
         if not os.access(input, os.R_OK):
             raise PermissionError('\'{}\' is not readable'.format(input))
 
@@ -104,21 +201,21 @@ class Parser:
         output = pathlib.Path(self.config.output_dir)
 
         # validate base dir exists and is a directory and is writable
-        self.logger.debug('Checking if \'{}\' exists'.format(output))
+        self.logger.debug('Checking if \'%s\' exists', output)
         if not output.is_dir():
             raise NotADirectoryError('\'{}\' is not a directory'.format(output))
-        self.logger.debug('Checking if \'{}\' is writable'.format(output))
+        self.logger.debug('Checking if \'%s\' is writable', output)
         if not os.access(output, os.W_OK):
             raise PermissionError('\'{}\' is not writable'.format(output))
 
         def join_path(dir: str) -> pathlib.Path:
             new_out = output.joinpath(sanitize_filepath(dir))
             # if it doesn't exist, create it
-            self.logger.debug('Checking if \'{}\' exists'.format(new_out))
+            self.logger.debug('Checking if \'%s\' exists', new_out)
             if not new_out.exists():
-                self.logger.debug('Creating nested output folder \'{}\''.format(new_out))
+                self.logger.debug('Creating nested output folder \'%s\'', new_out)
                 os.mkdir(new_out)
-            self.logger.debug('Checking if \'{}\' is writable'.format(new_out))
+            self.logger.debug('Checking if \'%s\' is writable', new_out)
             if not os.access(new_out, os.W_OK):
                 raise PermissionError('\'{}\' is not writable'.format(new_out))
 
@@ -126,14 +223,14 @@ class Parser:
 
         if self.config.create_author_dir:
             author = self.config.author_override or meta.author
-            self.logger.debug('Using author \'{}\''.format(author))
+            self.logger.debug('Using author \'%s\'', author)
             output = join_path(author)
         if self.config.create_title_dir:
             title = self.config.title_override or meta.title
-            self.logger.debug('Using title \'{}\''.format(title))
+            self.logger.debug('Using title \'%s\'', title)
             output = join_path(title)
 
-        self.logger.info('Full output dir: \'{}\''.format(output))
+        self.logger.info('Full output dir: \'%s\'', output)
         return str(output)
 
     def _probe_meta(self) -> MetaData:
@@ -154,6 +251,9 @@ class Parser:
                 author = info['format']['tags']['artist'] or info['format']['tags']['album_artist'] or 'Unknown'
                 self.logger.debug('Probed author %s', author)
 
+                duration = float(info['format'].get('duration', 0))
+                self.logger.debug('Probed duration %.3f', duration)
+
                 raw_chapters = info['chapters'] or []
                 chapters = [Chapter.from_probe(c) for c in raw_chapters]
                 self.logger.debug('Probed %d chapters', len(chapters))
@@ -187,21 +287,66 @@ class Parser:
             author=self.config.author_override or author,
             title=self.config.title_override or title,
             activation_bytes=activation_bytes,
+            duration=duration,
             chapters=chapters,
         )
 
-    def _format_audio(self, meta: MetaData, outdir: str):
-        self.logger.warning('Saving mp3s to {}'.format(outdir))
+    def _detect_chapters(self, meta: MetaData) -> List[Chapter]:
+        """Build chapters from the silences in the audio for files without chapter markers"""
+        min_length = self.config.min_chapter_length
+        max_length = self.config.max_chapter_length
+        if min_length <= 0 or max_length <= min_length:
+            raise ValueError('Invalid chapter lengths: min {}s, max {}s'.format(min_length, max_length))
+
+        self.logger.warning('No chapters found, detecting chapters from silence')
+        duration = meta.duration
+        try:
+            splits, duration = detect_splits(
+                self.config.input_file,
+                meta.activation_bytes,
+                meta.duration,
+                min_length,
+                max_length,
+                quiet=not self._stream_ffmpeg_output(),
+            )
+        except Exception as e:
+            if not self.config.force or duration <= 0:
+                raise Exception('Unable to detect chapters from silence.') from e
+
+            self.logger.error('Silence detection failed, splitting every %ds: %s', max_length, e)
+            splits = fixed_splits(duration, max_length)
+
+        bounds = [0.0] + splits + [duration]
+        chapters = [
+            Chapter(title='Chapter {}'.format(num+1), start='{:.3f}'.format(start), end='{:.3f}'.format(end))
+            for num, (start, end) in enumerate(zip(bounds, bounds[1:]))
+        ]
+        self.logger.debug('Detected %d chapters', len(chapters))
+        return chapters
+
+    def _stream_ffmpeg_output(self) -> bool:
+        """Let ffmpeg write to our stderr directly. Only when debugging, and never in JSON mode."""
+        return self.logger.isEnabledFor(logging.DEBUG) and not self.config.log_json
+
+    def _run_ffmpeg(self, stream):
+        if self._stream_ffmpeg_output():
+            stream.run()
+            return
+
+        _, stderr = stream.run(capture_stdout=True, capture_stderr=True)
+        if stderr and self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug('ffmpeg output:\n%s', stderr.decode('utf-8', 'replace').strip())
 
-        capture_output = False if self.logger.isEnabledFor(logging.DEBUG) else True
+    def _format_audio(self, meta: MetaData, outdir: str):
+        self.logger.warning('Saving mp3s to %s', outdir)
 
         self.logger.debug('Extracting cover art')
-        (
-            ffmpeg
-                .input(self.config.input_file, y=None, activation_bytes=meta.activation_bytes)
-                .output(os.path.join(outdir, 'cover.jpg'), an=None, vcodec='copy')
-                .run(capture_stdout=capture_output, capture_stderr=capture_output)
-        )
+        with self._log_stage('cover'):
+            self._run_ffmpeg(
+                ffmpeg
+                    .input(self.config.input_file, y=None, activation_bytes=meta.activation_bytes)
+                    .output(os.path.join(outdir, 'cover.jpg'), an=None, vcodec='copy')
+            )
 
         # Run a parse command for each chapter
         num_chapters = len(meta.chapters)
@@ -214,7 +359,8 @@ class Parser:
 
         for num, chapter in enumerate(meta.chapters):
             track = num+1
-            self.logger.warning('Processing chapter \'{}\' ({} of {})'.format(chapter.title, track, num_chapters))
+            self.logger.warning('Processing chapter \'%s\' (%s of %s)', chapter.title, track, num_chapters,
+                extra={'stage': 'encode', 'chapter': track})
 
             filename = '{} - {}.mp3'.format(str(track).rjust(padding, '0'), chapter.title)
 
@@ -238,13 +384,13 @@ class Parser:
             }
 
             outfile = os.path.join(outdir, filename)
-            self.logger.debug('Saving chapter to {}'.format(outfile))
-
-            (
-                ffmpeg
-                    .input(self.config.input_file, **input_args)
-                    .output(outfile, **output_args)
-                    .run(capture_stdout=capture_output, capture_stderr=capture_output)
-            )
+            self.logger.debug('Saving chapter to %s', outfile)
+
+            with self._log_stage('encode', chapter=track):
+                self._run_ffmpeg(
+                    ffmpeg
+                        .input(self.config.input_file, **input_args)
+                        .output(outfile, **output_args)
+                )
 
         self.logger.warning('Done')
@@ -0,0 +1,89 @@
+import cProfile
+import io
+import os
+import pstats
+import resource
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Any, Callable, List, Optional
+
+# Number of functions listed in the summary
+SUMMARY_LIMIT = 30
+
+
+@dataclass
+class StageTiming:
+    """Time spent in the ffmpeg children of a single stage"""
+    stage: str
+    chapter: Optional[int]
+    wall: float
+    user: float
+    system: float
+
+class JobProfiler:
+    """Profiles a single parse: the Python side with cProfile, the ffmpeg children with getrusage"""
+    timings: List[StageTiming]
+    output_dir: Optional[str]
+
+    def __init__(self) -> None:
+        self.timings = []
+        self.output_dir = None
+        self._profile = cProfile.Profile()
+        self._wall = self._cpu = 0.0
+
+    def runcall(self, func: Callable[[], Any]) -> Any:
+        wall = time.monotonic()
+        cpu = time.process_time()
+        try:
+            return self._profile.runcall(func)
+        finally:
+            self._wall = time.monotonic() - wall
+            self._cpu = time.process_time() - cpu
+
+    @contextmanager
+    def measure(self, stage: str, chapter: Optional[int] = None):
+        """Record the wall and CPU time of the child processes run inside the block"""
+        before = resource.getrusage(resource.RUSAGE_CHILDREN)
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            wall = time.monotonic() - start
+            after = resource.getrusage(resource.RUSAGE_CHILDREN)
+            self.timings.append(StageTiming(
+                stage=stage,
+                chapter=chapter,
+                wall=wall,
+                user=after.ru_utime - before.ru_utime,
+                system=after.ru_stime - before.ru_stime,
+            ))
+
+    def write(self, output_dir: str, name: str) -> str:
+        """Write `<name>.prof` and a `<name>.profile.txt` summary to output_dir. Returns the summary path."""
+        self._profile.dump_stats(os.path.join(output_dir, '{}.prof'.format(name)))
+
+        summary = os.path.join(output_dir, '{}.profile.txt'.format(name))
+        with open(summary, 'w') as f:
+            f.write(self.summary())
+        return summary
+
+    def summary(self) -> str:
+        child_user = sum(t.user for t in self.timings)
+        child_system = sum(t.system for t in self.timings)
+        child_wall = sum(t.wall for t in self.timings)
+
+        out = io.StringIO()
+        out.write('Total wall time:   {:10.2f}s\n'.format(self._wall))
+        out.write('Python CPU time:   {:10.2f}s\n'.format(self._cpu))
+        out.write('ffmpeg wall time:  {:10.2f}s\n'.format(child_wall))
+        out.write('ffmpeg CPU time:   {:10.2f}s (user {:.2f}s, system {:.2f}s)\n'.format(
+            child_user + child_system, child_user, child_system))
+        out.write('\n{:<10} {:>8} {:>10} {:>10} {:>10}\n'.format('stage', 'chapter', 'wall', 'user', 'system'))
+        for t in self.timings:
+            out.write('{:<10} {:>8} {:>9.2f}s {:>9.2f}s {:>9.2f}s\n'.format(
+                t.stage, '' if t.chapter is None else t.chapter, t.wall, t.user, t.system))
+
+        out.write('\n')
+        pstats.Stats(self._profile, stream=out).sort_stats(pstats.SortKey.CUMULATIVE).print_stats(SUMMARY_LIMIT)
+        return out.getvalue()
@@ -0,0 +1,37 @@
+import os
+import re
+from logging import Logger
+from typing import List
+
+from mutagen.id3 import ID3, ID3NoHeaderError, TALB, TIT2, TPE1, TRCK
+
+# Chapter files are saved as '<track> - <title>.mp3'
+CHAPTER_FILE = re.compile(r'^(\d+) - (.*)\.mp3$', re.IGNORECASE)
+
+
+def chapter_files(directory: str) -> List[str]:
+    """The chapter mp3s in the directory, in track order"""
+    return sorted(f for f in os.listdir(directory) if CHAPTER_FILE.match(f))
+
+def retag_chapters(directory: str, album: str, artist: str, logger: Logger) -> int:
+    """Rewrite the title/track/album/artist ID3 frames of the chapter mp3s in place. Returns the number of files."""
+    files = chapter_files(directory)
+    for filename in files:
+        match = CHAPTER_FILE.match(filename)
+        track, title = int(match.group(1)), match.group(2)
+
+        path = os.path.join(directory, filename)
+        logger.debug('Retagging \'%s\'', path)
+        try:
+            tags = ID3(path)
+        except ID3NoHeaderError:
+            tags = ID3()
+
+        tags.setall('TIT2', [TIT2(encoding=3, text=title)])
+        tags.setall('TRCK', [TRCK(encoding=3, text=str(track))])
+        tags.setall('TALB', [TALB(encoding=3, text=album)])
+        tags.setall('TPE1', [TPE1(encoding=3, text=artist)])
+        # Match the id3v2_version ffmpeg writes
+        tags.save(path, v2_version=3)
+
+    return len(files)
@@ -0,0 +1,126 @@
+import ffmpeg
+import numpy as np
+import subprocess
+import tempfile
+from typing import BinaryIO, List, Tuple
+
+# Decode at a low rate, mono. Plenty of resolution to find pauses in speech.
+SAMPLE_RATE = 8000
+WINDOW_SECONDS = 0.1
+SILENCE_THRESHOLD_DB = -40.0
+MIN_SILENCE_SECONDS = 1.0
+
+# Bytes read from ffmpeg per iteration (~1 minute of s16le mono audio)
+READ_SIZE = SAMPLE_RATE * 2 * 60
+
+
+def window_levels(stream: BinaryIO, window_samples: int) -> np.ndarray:
+    """Read s16le PCM from the stream and return the RMS level (dBFS) of each window
+
+    Only one read buffer and the per-window levels are ever held in memory, so
+    long books decode in bounded memory.
+    """
+    window_bytes = window_samples * 2
+    levels = []
+    leftover = b''
+    while True:
+        chunk = stream.read(READ_SIZE)
+        if not chunk:
+            break
+
+        buf = leftover + chunk
+        usable = len(buf) - len(buf) % window_bytes
+        leftover = buf[usable:]
+        if usable == 0:
+            continue
+
+        frames = np.frombuffer(buf[:usable], dtype='<i2').astype(np.float32).reshape(-1, window_samples)
+        levels.append(np.sqrt(np.mean(np.square(frames), axis=1)))
+
+    if not levels:
+        return np.empty(0, dtype=np.float32)
+
+    rms = np.concatenate(levels)
+    return 20 * np.log10(rms / 32768.0 + 1e-10)
+
+def find_silences(levels: np.ndarray, window: float, threshold_db: float, min_silence: float) -> Tuple[np.ndarray, np.ndarray]:
+    """Find the runs of windows below the threshold. Returns the (starts, ends) in seconds."""
+    quiet = np.concatenate(([False], levels < threshold_db, [False]))
+    edges = np.diff(quiet.astype(np.int8))
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1)
+
+    keep = (ends - starts) * window >= min_silence
+    return starts[keep] * window, ends[keep] * window
+
+def plan_splits(starts: np.ndarray, ends: np.ndarray, duration: float, min_length: float, max_length: float) -> List[float]:
+    """Pick the split points (in seconds) for the chapters
+
+    Each split is made at the longest silence that keeps the chapter between
+    min_length and max_length. If there is no such silence, the chapter is cut
+    at max_length, or earlier if that would leave less than min_length at the end.
+    """
+    mids = (starts + ends) / 2
+    widths = ends - starts
+
+    splits = []
+    start = 0.0
+    while duration - start > max_length:
+        lo, hi = np.searchsorted(mids, [start + min_length, min(start + max_length, duration - min_length)])
+        if lo < hi:
+            split = float(mids[lo + np.argmax(widths[lo:hi])])
+        else:
+            remaining = duration - start
+            split = start + min(max_length, max(remaining - min_length, remaining / 2))
+        splits.append(split)
+        start = split
+
+    return splits
+
+def fixed_splits(duration: float, max_length: float) -> List[float]:
+    """Split points for cutting the duration in equal pieces of at most max_length"""
+    count = int(np.ceil(duration / max_length))
+    return [float(s) for s in np.linspace(0, duration, count + 1)[1:-1]]
+
+def detect_splits(
+    input_file: str,
+    activation_bytes: str,
+    duration: float,
+    min_length: float,
+    max_length: float,
+    quiet: bool = True,
+) -> Tuple[List[float], float]:
+    """Decode the file once and return the split points found from its silences, and the duration
+
+    When quiet, ffmpeg only reports errors and they are captured instead of written to our stderr.
+    """
+    window_samples = int(SAMPLE_RATE * WINDOW_SECONDS)
+
+    stream = (
+        ffmpeg
+            .input(input_file, activation_bytes=activation_bytes)
+            .output('pipe:', format='s16le', acodec='pcm_s16le', ac=1, ar=SAMPLE_RATE, vn=None)
+    )
+    if quiet:
+        stream = stream.global_args('-nostats', '-loglevel', 'error')
+
+    # stderr goes to a file rather than a pipe, so it can never fill up and stall the decode
+    with tempfile.TemporaryFile() as stderr:
+        process = subprocess.Popen(stream.compile(), stdout=subprocess.PIPE, stderr=stderr if quiet else None)
+        try:
+            levels = window_levels(process.stdout, window_samples)
+        finally:
+            process.stdout.close()
+            retcode = process.wait()
+
+        stderr.seek(0)
+        errors = stderr.read().decode('utf-8', 'replace').strip()
+
+    if retcode:
+        raise Exception('Unable to decode audio for silence detection. ffmpeg exited with {}: {}'.format(retcode, errors))
+
+    # Trust the decoded length over the container if they disagree
+    duration = max(duration, len(levels) * WINDOW_SECONDS)
+
+    starts, ends = find_silences(levels, WINDOW_SECONDS, SILENCE_THRESHOLD_DB, MIN_SILENCE_SECONDS)
+    return plan_splits(starts, ends, duration, min_length, max_length), duration
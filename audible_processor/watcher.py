@@ -4,7 +4,7 @@ import os
 import sys
 
 from env import Vars, envDefault
-from helpers import get_logger
+from helpers import get_logger, validate_chapter_lengths
 from src import AudibleTools, Daemon, DaemonConfig
 
 
@@ -22,17 +22,36 @@ def main(prog: str, args: array):
         help='The number of processors')
     parser.add_argument('-i', '--interval', default=envDefault(Vars.INTERVAL, 5), type=int,
         help='The interval in seconds to check for new files')
+    parser.add_argument('--min-chapter-length', default=envDefault(Vars.MIN_CHAPTER_LENGTH, 300), type=int,
+        help='The minimum length in seconds of a chapter detected from silence (files without chapter markers)')
+    parser.add_argument('--max-chapter-length', default=envDefault(Vars.MAX_CHAPTER_LENGTH, 1800), type=int,
+        help='The maximum length in seconds of a chapter detected from silence (files without chapter markers)')
+    parser.add_argument('--control-socket', default=envDefault(Vars.CONTROL_SOCKET, ''),
+        help='Serve the job control API on this unix socket')
+    parser.add_argument('--control-port', default=envDefault(Vars.CONTROL_PORT, 0), type=int,
+        help='Serve the job control API on this localhost port (0 to disable)')
+    parser.add_argument('--prefetch', default=envDefault(Vars.PREFETCH, 0), type=int,
+        help='The number of queued books to read ahead while others are processed (0 to disable)')
+    parser.add_argument('--prefetch-cache', default=envDefault(Vars.PREFETCH_CACHE, ''),
+        help='Copy prefetched books into this local directory instead of only the page cache')
+    parser.add_argument('--prefetch-cache-size', default=envDefault(Vars.PREFETCH_CACHE_SIZE, 4096), type=int,
+        help='The maximum size in MiB of the prefetch cache directory')
+    parser.add_argument('--profile', default=False, action='store_true',
+        help='Profile every book and save a .prof file and a summary next to its output')
     parser.add_argument('-v', '--verbose', default=envDefault(Vars.VERBOSITY, 0), action='count')
+    parser.add_argument('--log-json', default=envDefault(Vars.LOG_JSON, False), action=argparse.BooleanOptionalAction,
+        help='Write the logs as one JSON object per line')
     parser.add_argument('path', default=envDefault(Vars.INPUT_DIR, ''),
         help='The directory that we are going to monitor')
 
     options = parser.parse_args(args)
+    validate_chapter_lengths(parser, options)
 
     if options.path is None or not options.path.strip():
         parser.print_usage()
         sys.exit(1)
 
-    logger = get_logger(__name__, options.verbose)
+    logger = get_logger(__name__, options.verbose, options.log_json)
     audible = AudibleTools(options.out, logger)
 
     config = DaemonConfig(
@@ -42,6 +61,15 @@ def main(prog: str, args: array):
         create_title_dir=options.title_dir,
         interval=options.interval,
         threads=options.threads,
+        min_chapter_length=options.min_chapter_length,
+        max_chapter_length=options.max_chapter_length,
+        control_socket=options.control_socket,
+        control_port=options.control_port,
+        profile=options.profile,
+        log_json=options.log_json,
+        prefetch=options.prefetch,
+        prefetch_cache=options.prefetch_cache,
+        prefetch_cache_size=options.prefetch_cache_size,
     )
 
     try: